@@ -1,22 +1,62 @@
+import asyncio
+import csv
 import os
+import random
 import re
+import sqlite3
+from email.utils import parsedate_to_datetime
 import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from types import MappingProxyType
 from typing import Optional
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
-import requests
-from pydantic import BaseModel
-from requests import HTTPError
+import httpx
+import orjson
+from httpx import HTTPStatusError, TransportError
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 
 API_KEY = os.getenv("GOOGLE_API_KEY")
 BASE_URL = 'https://www.googleapis.com/civicinfo/v2/representatives'
+# Parameters shared by every request; read-only so a lookup can't mutate it
+_BASE_PARAMS = MappingProxyType({'key': API_KEY})
 
 STATE_HOUSE_ID = 'sldl'
 STATE_SENATE_ID = 'sldu'
-US_HOUSE_ID = 'cd:'
+US_HOUSE_ID = 'cd'
+
+# Division type (the last OCD-ID segment, before the ':') -> RowItem field
+DIVISION_FIELDS = {
+    STATE_HOUSE_ID: 'state_house',
+    STATE_SENATE_ID: 'state_senate',
+    US_HOUSE_ID: 'us_house',
+}
 
 TOO_MANY_REQUESTS_STATUS_CODE = 429
+SERVER_ERROR_STATUS_CODE = 500
+
+STATE_HOUSE_REP_COLUMN = 'State House Rep.'
+OUTPUT_COLUMNS = [
+    'State House District',
+    STATE_HOUSE_REP_COLUMN,
+    'State Senate District',
+    'State Senate Rep.',
+    'US House District',
+    'US House Rep.',
+]
+
+CACHE_PATH = 'cache/civicinfo.db'
+# Representatives change after elections and redistricting, so cached lookups expire
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+PARTIAL_SUFFIX = '.partial'
+
+MAX_WORKERS = 16
+REQUEST_TIMEOUT = 10.0
 
 
 import signal
@@ -30,13 +70,47 @@ def handle_sigint(signum, frame):
 
 signal.signal(signal.SIGINT, handle_sigint)
 
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """Seconds to wait according to the Retry-After header, or None if absent or unparseable."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
 class AdaptiveRateLimiter:
-    def __init__(self, initial_delay=1.0, initial_alpha=2, max_delay=30.0, min_delay=0.1):
+    """
+    Global request pacer shared by all in-flight lookups.
+    One request slot is handed out every `delay` seconds, so `delay` is the inverse of the request rate.
+    """
+    def __init__(
+            self,
+            initial_delay=1.0,
+            initial_alpha=2,
+            max_delay=30.0,
+            min_delay=0.1,
+            success_streak_to_decay=10
+    ):
         self.delay = initial_delay
         self.initial_alpha = initial_alpha
         self.update_count = 0
         self.max_delay = max_delay
         self.min_delay = min_delay
+        self.success_streak_to_decay = success_streak_to_decay
+        self.success_streak = 0
+        self._next_slot = 0.0
+        # Bumped on every rate-limit adjustment; a 429 from a request sent under an older
+        # generation belongs to a burst we've already reacted to
+        self.generation = 0
+        # While set, requests go through `single_flight` one at a time until one succeeds
+        self.rate_limited = asyncio.Event()
+        self.single_flight = asyncio.Semaphore(1)
 
     def _compute_alpha(self):
         return self.initial_alpha / (1 + self.update_count)
@@ -52,130 +126,338 @@ class AdaptiveRateLimiter:
             )
         )
 
-    def on_success(self):
+    def on_success(self, generation, gated):
+        # Only a request that went through the gate after the last 429 proves we're clear again;
+        # older in-flight requests succeeding says nothing about the current rate
+        if gated and generation == self.generation:
+            self.rate_limited.clear()
+        self.success_streak += 1
+        if self.success_streak >= self.success_streak_to_decay:
+            # A long clean run means we're well under quota; close half the gap to the floor at once,
+            # since the shrinking EMA alpha would otherwise take ever longer to get there
+            self.success_streak = 0
+            self.delay = self.min_delay + (self.delay - self.min_delay) / 2
+            return
         target = self.delay * 0.9
         self._apply_ema(target)
 
-    def on_rate_limit(self):
-        target = self.delay * 2.0
-        self._apply_ema(target)
-        print(f"[429] Rate limited. Sleeping {self.delay:.2f}s...")
-        self.sleep()
-
-    def sleep(self):
-        time.sleep(self.delay)
-
-    def request(self, make_request_fn, params, max_attempts=5):
+    async def on_rate_limit(self, attempt, generation, retry_after: Optional[float] = None):
+        self.rate_limited.set()
+        self.success_streak = 0
+        # Back off from the delay the request was sent under, not one this 429 may have just doubled
+        base_delay = self.delay
+        if generation == self.generation:
+            # First 429 since the last adjustment; the rest of the burst shouldn't compound it
+            self.generation += 1
+            if retry_after:
+                # The server said exactly how long to wait, so trust it over our own guess
+                self.delay = min(self.max_delay, max(self.delay, retry_after))
+            else:
+                # Halve the request rate outright rather than easing toward it
+                self.delay = min(self.max_delay, self.delay * 2.0)
+        if retry_after:
+            backoff = retry_after + random.uniform(0, 0.5)
+        else:
+            backoff = min(self.max_delay, base_delay * 2 ** attempt) + random.uniform(0, 1)
+        print(f"[429] Rate limited. Sleeping {backoff:.2f}s...")
+        await asyncio.sleep(backoff)
+
+    async def on_server_error(self, attempt, reason):
+        self.success_streak = 0
+        # Full jitter: the failure isn't about our rate, so just spread the retries out
+        backoff = random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt))
+        print(f"[{reason}] Request failed. Sleeping {backoff:.2f}s...")
+        await asyncio.sleep(backoff)
+
+    async def acquire(self) -> int:
+        """Wait for the next request slot, returning the generation it was claimed under."""
+        # Everything runs on one event loop, so claiming the slot needs no lock
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.delay
+        generation = self.generation
+        await asyncio.sleep(slot - now)
+        return generation
+
+    @asynccontextmanager
+    async def _slot(self):
+        """
+        Wait for a request slot, yielding the generation its pacing was decided under
+        and whether it went through the single-flight gate.
+        """
+        if self.rate_limited.is_set():
+            # Take the slot only once it's our turn, so each probe is paced at the backed-off delay
+            async with self.single_flight:
+                yield await self.acquire(), True
+        else:
+            yield await self.acquire(), False
+
+    async def request(self, make_request_fn, *args, max_attempts=5):
         for attempt in range(max_attempts):
+            generation = self.generation
             try:
-                result = make_request_fn(params)
-                self.on_success()
+                async with self._slot() as (generation, gated):
+                    result = await make_request_fn(*args)
+                self.on_success(generation, gated)
                 return result
-            except HTTPError as e:
-                if e.response.status_code == TOO_MANY_REQUESTS_STATUS_CODE:
-                    self.on_rate_limit()
+            except HTTPStatusError as e:
+                status_code = e.response.status_code
+                if status_code == TOO_MANY_REQUESTS_STATUS_CODE:
+                    await self.on_rate_limit(attempt, generation, parse_retry_after(e.response))
+                elif status_code >= SERVER_ERROR_STATUS_CODE:
+                    await self.on_server_error(attempt, status_code)
                 else:
                     raise
-        return make_request_fn(params)
+            except TransportError as e:
+                # Timeouts and dropped HTTP/2 connections are transient; retry like a 5xx
+                await self.on_server_error(attempt, type(e).__name__)
+        async with self._slot() as (generation, gated):
+            result = await make_request_fn(*args)
+        self.on_success(generation, gated)
+        return result
 
 
-class DistrictAndRep(BaseModel):
+@dataclass(slots=True)
+class DistrictAndRep:
     district_number: Optional[int] = None
     representative_name: Optional[str] = None
     party: Optional[str] = None
 
-class RowItem(BaseModel):
+@dataclass(slots=True)
+class RowItem:
     state_house: Optional[DistrictAndRep] = None  # sldl
     state_senate: Optional[DistrictAndRep] = None  # sldu
     us_house: Optional[DistrictAndRep] = None  # cd = congressional district
 
-def extract_district_and_rep(data: dict, info: dict) -> DistrictAndRep:
-    district_name = info['name']
-    district_number = re.search(r'\d+', district_name).group(0)
-    office_index = info['officeIndices'][0]
-    official_index = data['offices'][office_index]['officialIndices'][0]
-    official_info = data['officials'][official_index]
+    @classmethod
+    def from_dict(cls, data: dict) -> 'RowItem':
+        """Rebuild a RowItem from its serialized dict form."""
+        return cls(**{
+            name: DistrictAndRep(**value) if value is not None else None
+            for name, value in data.items()
+        })
+
+_DIGITS = re.compile(r'(\d+)')
+_PUNCTUATION = re.compile(r'[^\w\s]')
+_WHITESPACE = re.compile(r'\s+')
+
+@lru_cache(maxsize=None)
+def normalize_address(address: str) -> str:
+    """Cache key for an address: upper-cased, punctuation stripped, whitespace collapsed."""
+    address = _PUNCTUATION.sub(' ', address.upper())
+    return _WHITESPACE.sub(' ', address).strip()
+
+class AddressCache:
+    """Persistent address -> RowItem cache, so repeat addresses never hit the API twice."""
+    def __init__(self, path=CACHE_PATH, max_age=CACHE_MAX_AGE):
+        self.max_age = max_age
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS row_items '
+            '(addr_key TEXT PRIMARY KEY, json BLOB, ts INTEGER)'
+        )
+        # In-process layer so repeats within a run skip SQLite and JSON parsing
+        self.memory: dict[str, RowItem] = {}
+
+    def get(self, address: str) -> Optional[RowItem]:
+        key = normalize_address(address)
+        row_item = self.memory.get(key)
+        if row_item is not None:
+            return row_item
+        row = self.connection.execute(
+            'SELECT json, ts FROM row_items WHERE addr_key = ? AND ts >= ?',
+            (key, int(time.time() - self.max_age))
+        ).fetchone()
+        if row is None:
+            return None
+        row_item = RowItem.from_dict(orjson.loads(row[0]))
+        self.memory[key] = row_item
+        return row_item
+
+    def set(self, address: str, row_item: RowItem):
+        key = normalize_address(address)
+        self.memory[key] = row_item
+        self.connection.execute(
+            'INSERT OR REPLACE INTO row_items (addr_key, json, ts) VALUES (?, ?, ?)',
+            (key, orjson.dumps(row_item), int(time.time()))
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def extract_district_and_rep(offices: list, officials: list, info: dict) -> DistrictAndRep:
+    district_number = int(_DIGITS.search(info['name']).group(1))
+    office = offices[info['officeIndices'][0]]
+    official_info = officials[office['officialIndices'][0]]
     official_name = official_info['name']
     party = official_info.get('party')[0]
     return DistrictAndRep(
-        district_number = int(district_number),
+        district_number=district_number,
         representative_name=official_name,
         party=party
     )
 
+@lru_cache(maxsize=8192)
+def _district_name(party: Optional[str], term: str, district_number: Optional[int]) -> str:
+    return f"{party} {term} District {district_number}"
+
 def district_name(district: DistrictAndRep, term: str) -> str:
-    return f"{district.party} {term} District {district.district_number}"
+    # Every voter in a district shares the same label, so build each one only once
+    return _district_name(district.party, term, district.district_number)
 
 def add_if_dont_exist(existing: list, new: list):
+    """Append the items of `new` not already in `existing`, in order. Items must be hashable."""
+    seen = set(existing)
     for item in new:
-        if item not in existing:
+        if item not in seen:
+            seen.add(item)
             existing.append(item)
 
-def process_row(df: pd.DataFrame, idx, rate_limiter):
-    row = df.iloc[idx]
-    address = row['address']
-    districts = get_legislative_districts(address, rate_limiter)
+def process_row(districts: RowItem) -> dict:
+    """Build the output columns for one address; missing districts are left as None."""
+    record = dict.fromkeys(OUTPUT_COLUMNS)
     if districts.state_house is not None:
-        df.at[idx, 'State House District'] = district_name(districts.state_house, 'House')
-        df.at[idx, 'State House Rep.'] = districts.state_house.representative_name
+        record['State House District'] = district_name(districts.state_house, 'House')
+        record['State House Rep.'] = districts.state_house.representative_name
     if districts.state_senate is not None:
-        df.at[idx, 'State Senate District'] = district_name(districts.state_senate, 'Senate')
-        df.at[idx, 'State Senate Rep.'] = districts.state_senate.representative_name
+        record['State Senate District'] = district_name(districts.state_senate, 'Senate')
+        record['State Senate Rep.'] = districts.state_senate.representative_name
     if districts.us_house is not None:
-        df.at[idx, 'US House District'] = district_name(districts.us_house, 'US House')
-        df.at[idx, 'US House Rep.'] = districts.us_house.representative_name
+        record['US House District'] = district_name(districts.us_house, 'US House')
+        record['US House Rep.'] = districts.us_house.representative_name
+    return record
+
+def address_keys(df: pd.DataFrame) -> pd.Series:
+    """Normalized address for every row, so rows can be matched to per-address results."""
+    return df['address'].astype(str).map(normalize_address)
+
+def apply_results(df: pd.DataFrame, keys: pd.Series, updates: pd.DataFrame):
+    """Broadcast per-address updates (indexed by normalized address) to every row in `keys`, in one update."""
+    updates = updates[~updates.index.duplicated(keep='last')].reindex(keys.to_numpy())
+    updates.index = keys.index
+    df.update(updates)
+
+def merge_partial(df: pd.DataFrame, partial_path: str):
+    """Recover addresses checkpointed by a run that was killed before it could save."""
+    if not os.path.exists(partial_path) or os.path.getsize(partial_path) == 0:
+        return
+    updates = pd.read_csv(partial_path, dtype=object)
+    updates.index = updates.pop('address').map(normalize_address)
+    apply_results(df, address_keys(df), updates)
+
+def save_results(df: pd.DataFrame, file_path: str, keys: pd.Series, results: dict[str, dict]):
+    if results:
+        apply_results(df, keys, pd.DataFrame.from_dict(results, orient='index', columns=OUTPUT_COLUMNS))
+    # Write beside the original and swap it in, so a crash mid-write can't corrupt the source CSV
+    tmp_path = file_path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, file_path)
+    # Everything checkpointed is now in the main file
+    partial_path = file_path + PARTIAL_SUFFIX
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+
+async def fetch_rows(addresses, rate_limiter: AdaptiveRateLimiter, cache: AddressCache, on_result):
+    """Look up every address concurrently, handing each result to `on_result` as it lands."""
+    semaphore = asyncio.Semaphore(MAX_WORKERS)
+    # One client for the whole run, so every lookup reuses its kept-alive connections
+    limits = httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=REQUEST_TIMEOUT) as client:
+        async def bound_fetch(address):
+            # Cache hits never touch the network, so they skip the semaphore and pacer
+            districts = cache.get(address)
+            if districts is None:
+                async with semaphore:
+                    if should_stop:
+                        return
+                    districts = await get_legislative_districts(client, address, rate_limiter)
+                cache.set(address, districts)
+            on_result(address, districts)
+
+        tasks = [asyncio.ensure_future(bound_fetch(address)) for address in addresses]
+        try:
+            await tqdm_asyncio.gather(*tasks)
+        finally:
+            # Don't leave lookups running once one has failed, and let them unwind before the client closes
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def process_csv(file_path):
     tqdm.pandas()
+    # The C engine handles quoted multi-line addresses, which pandas' pyarrow engine can't
     df = pd.read_csv(file_path)
-    # Filter rows where new_col1 is missing
-    state_house_rep_column = "State House Rep."
-    if state_house_rep_column not in df.columns:
-        df[state_house_rep_column] = pd.NA  # or None, or "" if working with strings
-    mask = df[state_house_rep_column].isna()
+    # Create all output columns up front so no row adds a column
+    missing_columns = [column for column in OUTPUT_COLUMNS if column not in df.columns]
+    df = df.reindex(columns=[*df.columns, *missing_columns], fill_value=pd.NA)
+    # Arrow-backed strings are far smaller than boxed Python str objects
+    df[OUTPUT_COLUMNS] = df[OUTPUT_COLUMNS].astype(pd.ArrowDtype(pa.string()))
+    partial_path = file_path + PARTIAL_SUFFIX
+    merge_partial(df, partial_path)
+    # Positions of rows where the state house rep is missing, without building a filtered frame
+    positions = np.flatnonzero(df[STATE_HOUSE_REP_COLUMN].isna().to_numpy())
+    addresses = df['address'].iloc[positions].astype(str)
+    keys = addresses.map(normalize_address)
+    # Households with several registrants share an address; look each one up once
+    todo = addresses[~keys.duplicated()]
 
     rate_limiter = AdaptiveRateLimiter()
-    # Apply with progress bar
+    cache = AddressCache()
+    results: dict[str, dict] = {}
+    # Lookups only fetch; results are collected here and written to the dataframe in bulk
     try:
-        for idx in tqdm(df[mask].index):
-            if should_stop:
-                break
-            process_row(df, idx, rate_limiter)
-            rate_limiter.sleep()
-    except Exception as e:
-        df.to_csv(file_path, index=False)
-        raise e
-
-    # Save back to same file
-    df.to_csv(file_path, index=False)
-
-
-
-def get_legislative_districts(address, rate_limiter: AdaptiveRateLimiter) -> RowItem:
-    params = {
-        'key': API_KEY,
-        'address': address,
-    }
-    data = rate_limiter.request(make_request, params)
+        # Each finished address is also appended to a checkpoint file, so a hard kill loses nothing
+        with open(partial_path, 'a', newline='') as partial_file:
+            writer = csv.writer(partial_file)
+            if partial_file.tell() == 0:
+                writer.writerow(['address', *OUTPUT_COLUMNS])
+
+            def record_result(address: str, districts: RowItem):
+                record = process_row(districts)
+                writer.writerow([address, *record.values()])
+                partial_file.flush()
+                results[normalize_address(address)] = record
+
+            asyncio.run(fetch_rows(todo.to_numpy(), rate_limiter, cache, record_result))
+    finally:
+        cache.close()
+        # Save back to same file, whether the run finished, was stopped, or failed
+        save_results(df, file_path, keys, results)
+
+
+
+async def get_legislative_districts(
+        client: httpx.AsyncClient,
+        address,
+        rate_limiter: AdaptiveRateLimiter
+) -> RowItem:
+    params = _BASE_PARAMS | {'address': address}
+    data = await rate_limiter.request(make_request, client, params)
 
     divisions = data.get('divisions', {})
 
+    offices = data.get('offices', [])
+    officials = data.get('officials', [])
     row_item = RowItem()
     for division_id, info in divisions.items():
-        if STATE_HOUSE_ID in division_id:
-            row_item.state_house = extract_district_and_rep(data, info)
-        if STATE_SENATE_ID in division_id:
-            row_item.state_senate = extract_district_and_rep(data, info)
-        if US_HOUSE_ID in division_id:
-            row_item.us_house = extract_district_and_rep(data, info)
+        # e.g. 'ocd-division/country:us/state:pa/sldl:12' -> 'sldl'
+        division_type = division_id[division_id.rfind('/') + 1:].partition(':')[0]
+        field = DIVISION_FIELDS.get(division_type)
+        if field is None:
+            continue
+        setattr(row_item, field, extract_district_and_rep(offices, officials, info))
 
     return row_item
 
-def make_request(params) -> dict:
-    response = requests.get(BASE_URL, params=params)
+async def make_request(client: httpx.AsyncClient, params) -> dict:
+    response = await client.get(BASE_URL, params=params)
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
 
 
 